@@ -1,4 +1,4 @@
-from .basic import Identity, Concatenate, Sum, DepthToChannel, Normalize, MultiplyByScalar, Upsample
+from .basic import Identity, Concatenate, ConvOnConcatenation, Sum, DepthToChannel, Normalize, MultiplyByScalar, Upsample
 from .multi_io import TakeChannels, ReduceIntermediateWith1x1
 from .recurrent import ConvGRU, ConvGRUCell
 from .experimental import MeanShiftLayer, ShakeShakeMerge, SampleChannels, AffinityBasedAveraging, \
@@ -24,10 +24,34 @@ class Concatenate(nn.Module):
         return torch.cat(inputs, dim=self.dim)
 
 
+class ConvOnConcatenation(nn.Module):
+    """
+    Convolution of the concatenation of the inputs along the channel axis, computed without concatenating them:
+    One convolution is applied to each input and the results are summed.
+    """
+    def __init__(self, *convs, post=None):
+        super(ConvOnConcatenation, self).__init__()
+        self.convs = nn.ModuleList(convs)
+        self.post = post
+
+    def forward(self, *inputs):
+        assert len(inputs) == len(self.convs), f'Expected {len(self.convs)} inputs, but got {len(inputs)}.'
+        result = self.convs[0](inputs[0])
+        for conv, input in zip(self.convs[1:], inputs[1:]):
+            result = result + conv(input)
+        if self.post is not None:
+            result = self.post(result)
+        return result
+
+
 class Sum(nn.Module):
     """Sum all inputs."""
     def forward(self, *inputs):
-        return torch.stack(inputs, dim=0).sum(0)
+        # add pairwise instead of stacking, which would allocate a tensor as large as all inputs together
+        result = inputs[0]
+        for input in inputs[1:]:
+            result = result + input
+        return result
 
 
 class DepthToChannel(nn.Module):
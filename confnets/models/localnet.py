@@ -1,6 +1,9 @@
+import logging
 import torch.nn as nn
 from confnets.blocks import ValidPadResBlock
 
+logger = logging.getLogger(__name__)
+
 
 class LocalNet(nn.Module):
     """
@@ -13,7 +16,7 @@ class LocalNet(nn.Module):
         self.blocks = nn.ModuleList([ValidPadResBlock(in_channels=f_in, main_channels=f_in // bottleneck_factor, kernel_size=k)
                                      for f_in, k in zip(fmaps[1:], kernel_sizes[1:])])
         self.fov = 1 + sum([k - 1 for k in kernel_sizes])
-        print(f'FOV of the local net: {self.fov}')
+        logger.debug('FOV of the local net: %s', self.fov)
 
     def forward(self, x):
         x = self.first_layer(x)
@@ -1,10 +1,13 @@
 import torch
 import numpy as np
+import warnings
+from torch.utils.checkpoint import checkpoint
 from collections import OrderedDict
 from functools import partial
+from inspect import signature
 
 from ..nn import delayed_nn as nn
-from ..layers import Identity, Concatenate, Sum, ConvGRU, ShakeShakeMerge, Upsample, MultiplyByScalar, ConvGRUCell
+from ..layers import Identity, Concatenate, ConvOnConcatenation, Sum, ConvGRU, ShakeShakeMerge, Upsample, MultiplyByScalar, ConvGRUCell
 from ..blocks import SuperhumanSNEMIBlock
 from .. import blocks
 from ..utils import skip_none_sequential, get_padding
@@ -17,13 +20,20 @@ class EncoderDecoderSkeleton(nn.Module):
     To add side-outputs, use a wrapper
     """
     # TODO: add input_module to draw.io
-    def __init__(self, depth):
+    def __init__(self, depth, use_checkpointing=False):
         super(EncoderDecoderSkeleton, self).__init__()
         self.depth = depth
+        # if True, activations inside the encoder modules are recomputed in the backward pass instead of stored.
+        # Note that the recomputation runs in train mode, so BatchNorm running statistics are updated twice per step.
+        self.use_checkpointing = use_checkpointing
         # construct all the layers
         self.initial_module = self.construct_input_module()
         self.encoder_modules = nn.ModuleList(
             [self.construct_encoder_module(i) for i in range(depth)])
+        if use_checkpointing and any(isinstance(module, torch.nn.modules.batchnorm._BatchNorm)
+                                     for module in self.encoder_modules.modules()):
+            warnings.warn('Checkpointing encoder modules that contain BatchNorm: their running statistics are '
+                          'updated twice per training step, as the forward pass is recomputed during backward.')
         self.skip_modules = nn.ModuleList(
             [self.construct_skip_module(i) for i in range(depth)])
         self.downsampling_modules = nn.ModuleList(
@@ -40,20 +50,48 @@ class EncoderDecoderSkeleton(nn.Module):
     def forward(self, input):
         encoded_states = []
         current = self.initial_module(input)
-        for encode, downsample in zip(self.encoder_modules, self.downsampling_modules):
-            current = encode(current)
+        for depth in range(self.depth):
+            if self.use_checkpointing and torch.is_grad_enabled():
+                current = checkpoint(self.encoder_modules[depth], current, use_reentrant=False)
+            else:
+                current = self.encoder_modules[depth](current)
             encoded_states.append(current)
-            current = downsample(current)
+            current = self.downsampling_modules[depth](current)
         current = self.base_module(current)
-        for encoded_state, upsample, skip, merge, decode in reversed(list(zip(
-                encoded_states, self.upsampling_modules, self.skip_modules, self.merge_modules, self.decoder_modules))):
-            current = upsample(current)
-            encoded_state = skip(encoded_state)
-            current = merge(current, encoded_state)
-            current = decode(current)
+        for depth in range(self.depth - 1, -1, -1):
+            current = self.upsampling_modules[depth](current)
+            encoded_state = self.skip_modules[depth](encoded_states[depth])
+            current = self.merge_modules[depth](current, encoded_state)
+            current = self.decoder_modules[depth](current)
         current = self.final_module(current)
         return current
 
+    def wrap_for_ddp(self, device, sync_batchnorm=False, bucket_cap_mb=50, **ddp_kwargs):
+        """
+        Move the model to device and wrap it in DistributedDataParallel. The process group has to be initialized.
+        :param device: int, str or torch.device
+        Device of the current process.
+        :param sync_batchnorm: bool
+        If True, BatchNorm layers are converted to SyncBatchNorm. GroupNorm does not need to be converted.
+        :param bucket_cap_mb: int
+        Size of the gradient buckets. Larger than the PyTorch default of 25, to reduce the number of all-reduce calls
+        for the large convolutions at intermediate depths.
+        :param ddp_kwargs:
+        Further arguments to DistributedDataParallel, e.g. find_unused_parameters.
+        :return: DistributedDataParallel
+        """
+        model = self
+        if sync_batchnorm:
+            model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        device = torch.device(device)
+        ddp_kwargs.setdefault('gradient_as_bucket_view', True)
+        return torch.nn.parallel.DistributedDataParallel(
+            model.to(device),
+            device_ids=[device] if device.type == 'cuda' else None,
+            bucket_cap_mb=bucket_cap_mb,
+            **ddp_kwargs
+        )
+
     def construct_input_module(self):
         return Identity()
 
@@ -84,7 +122,7 @@ class EncoderDecoderSkeleton(nn.Module):
 
 class UNetSkeleton(EncoderDecoderSkeleton):
 
-    def __init__(self, depth, in_channels, out_channels, fmaps, **kwargs):
+    def __init__(self, depth, in_channels, out_channels, fmaps, use_checkpointing=False, **kwargs):
         self.depth = depth
         self.in_channels = in_channels
         self.out_channels = out_channels
@@ -105,7 +143,7 @@ class UNetSkeleton(EncoderDecoderSkeleton):
 
         self.merged_fmaps = [2 * n for n in self.fmaps]
 
-        super(UNetSkeleton, self).__init__(depth)
+        super(UNetSkeleton, self).__init__(depth, use_checkpointing=use_checkpointing)
 
     def construct_layer(self, f_in, f_out):
         pass
@@ -152,6 +190,13 @@ class UNet(UNetSkeleton):
                  final_activation=None,
                  upsampling_mode='nearest',
                  skip_factor=1,
+                 inplace_activation=False,
+                 split_merge_conv=False,
+                 channels_last=False,
+                 amp_dtype=None,
+                 use_checkpointing=False,
+                 compile_norm_layers=False,
+                 compile_forward=False,
                  *super_args, **super_kwargs):
 
         self.dim = dim
@@ -186,6 +231,11 @@ class UNet(UNetSkeleton):
             assert hasattr(nn, activation), f'{activation} not found in nn'
             activation = getattr(nn, activation)
             assert isinstance(activation, type), f'{activation}, {type(activation)}'
+        if inplace_activation and isinstance(activation, type) and 'inplace' in signature(activation).parameters:
+            # saves memory during training, as every activation follows a convolution or normalization whose output
+            # is used nowhere else. Note however that the activation overwrites that output: forward hooks on the
+            # preceding conv or norm, e.g. of IntermediateOutputWrapper, then see post-activation values.
+            activation = partial(activation, inplace=True)
         if isinstance(activation, nn.Module):
             activation_module = activation
             activation = lambda: activation_module
@@ -212,25 +262,82 @@ class UNet(UNetSkeleton):
 
         self.skip_factor = skip_factor
 
+        # if True, the concatenation in the merge modules is fused with the first convolution of the decoder.
+        # Only possible if merge and decoder modules are both constructed by UNet.
+        if split_merge_conv:
+            assert type(self).construct_merge_module is UNet.construct_merge_module and \
+                type(self).construct_decoder_module is UNet.construct_decoder_module, \
+                f'split_merge_conv is not supported by {type(self).__name__}, ' \
+                f'as it overrides construct_merge_module or construct_decoder_module.'
+        self.split_merge_conv = split_merge_conv
+
         # compute input size divisibility constraints
         divisibility_constraint = np.ones(len(self.scale_factors[0]))
         for scale_factor in self.scale_factors:
             divisibility_constraint *= np.array(scale_factor)
         self.divisibility_constraint = list(divisibility_constraint.astype(int))
 
-        super(UNet, self).__init__(*super_args, **super_kwargs)
+        # if not None, forward runs under autocast with this dtype, e.g. torch.bfloat16
+        self.amp_dtype = amp_dtype
+
+        # if True, inputs are converted to channels-last memory format in forward; set by to_channels_last()
+        self.channels_last = False
+
+        super(UNet, self).__init__(*super_args, use_checkpointing=use_checkpointing, **super_kwargs)
 
         # run a forward pass to initialize all submodules (with in_channels=nn.INIT_DELAYED)
         with torch.no_grad():
             inp = torch.zeros((2, self.in_channels, *self.divisibility_constraint), dtype=torch.float32)
             self(inp)
 
+        if self.upsampling_mode == 'transpose_convolution':
+            self.init_upsampling_as_nearest()
+
         # delete attributes that are only relevant for construction and might lead to errors when model is saved
         del self.conv_type
         del self.norm_type
         del self.activation
         del self.conv_norm_act_dict
 
+        if channels_last:
+            self.to_channels_last()
+
+        # compile only after the delayed initialization above, such that the traced graph is static
+        if compile_norm_layers and not compile_forward:
+            self.compile_norm_layers()
+        if compile_forward:
+            self.compile(dynamic=False, mode='reduce-overhead')
+
+    def to_channels_last(self):
+        """
+        Convert parameters and inputs of all following forward passes to channels-last memory format,
+        such that the convolutions can use the faster NHWC kernels without layout conversions in between.
+        """
+        assert self.dim in (2, 3), f'Channels-last memory format is only available for dim 2 or 3. Got {self.dim}.'
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last if self.dim == 2 else torch.channels_last_3d)
+
+    def compile_norm_layers(self):
+        """
+        Separately compile every Sequential that directly contains a GroupNorm, such as the layers built by
+        construct_layer and the convolution stacks inside the blocks, such that normalization and activation are
+        fused into a single kernel. Not needed if the whole forward pass is compiled.
+        """
+        n_compiled = 0
+        for module in self.modules():
+            if isinstance(module, torch.nn.Sequential) and \
+                    any(isinstance(child, torch.nn.GroupNorm) for child in module.children()):
+                module.compile()
+                n_compiled += 1
+        if n_compiled == 0:
+            warnings.warn('compile_norm_layers: no layers with GroupNorm found, nothing was compiled.')
+        # all compiled layers share the code of Sequential.forward, and dynamo only keeps a limited number of
+        # compiled versions per code object. Allow one per layer, plus one more for when the input shape changes.
+        config = torch._dynamo.config
+        limit_name = 'recompile_limit' if hasattr(config, 'recompile_limit') else 'cache_size_limit'
+        setattr(config, limit_name, max(getattr(config, limit_name), 2 * n_compiled))
+        return self
+
     def construct_layer(self, f_in, f_out, kernel_size=3):
         return skip_none_sequential(OrderedDict([
             ('conv', self.conv_type(f_in, f_out, kernel_size=kernel_size, padding=get_padding(kernel_size))),
@@ -247,6 +354,31 @@ class UNet(UNetSkeleton):
         else:
             return self.conv_type(self.fmaps[0], self.out_channels, kernel_size=1)
 
+    def construct_merge_module(self, depth):
+        if not self.split_merge_conv:
+            return super(UNet, self).construct_merge_module(depth)
+        # equivalent to concatenation followed by the first layer of the decoder,
+        # but without allocating the concatenated tensor
+        f_out = self.fmaps[depth]
+        return ConvOnConcatenation(
+            self.conv_type(nn.INIT_DELAYED, f_out, kernel_size=3, padding=get_padding(3)),
+            self.conv_type(nn.INIT_DELAYED, f_out, kernel_size=3, padding=get_padding(3), bias=False),
+            post=skip_none_sequential(OrderedDict([
+                ('norm', self.norm_type(f_out)),
+                ('activation', self.activation())
+            ]))
+        )
+
+    def construct_decoder_module(self, depth):
+        if not self.split_merge_conv:
+            return super(UNet, self).construct_decoder_module(depth)
+        # the first layer of the decoder is part of the merge module
+        f_in = self.fmaps[depth]
+        f_out = f_in if depth == 0 else self.fmaps[depth - 1]
+        return nn.Sequential(
+            self.construct_layer(f_in, f_out)
+        )
+
     def construct_skip_module(self, depth):
         if self.skip_factor == 1:
             return Identity()
@@ -267,14 +399,37 @@ class UNet(UNetSkeleton):
         if self.upsampling_mode != 'transpose_convolution':
             sampler = Upsample(scale_factor=scale_factor, mode=self.upsampling_mode)
         else:
-            sampler = nn.ConvTranspose2d(kernel_size=scale_factor, stride=scale_factor)
+            # learnable upsampling, initialized to nearest neighbor upsampling in init_upsampling_as_nearest
+            conv_transpose = getattr(nn, f'ConvTranspose{self.dim}d')
+            sampler = conv_transpose(kernel_size=scale_factor, stride=scale_factor)
         return sampler
 
+    def init_upsampling_as_nearest(self):
+        """
+        Initialize all transposed convolutions used for upsampling such that they perform nearest neighbor upsampling.
+        """
+        with torch.no_grad():
+            for module in self.upsampling_modules:
+                if not isinstance(module, torch.nn.modules.conv._ConvTransposeNd):
+                    continue
+                assert module.in_channels == module.out_channels and module.groups == 1, \
+                    f'Can only initialize transposed convolutions with equal in- and output channels as upsampling.'
+                module.weight.zero_()
+                for channel in range(module.in_channels):
+                    module.weight[channel, channel] = 1
+                if module.bias is not None:
+                    module.bias.zero_()
+
     def forward(self, input_):
         input_dim = len(input_.shape)
         assert all(input_.shape[-i] % self.divisibility_constraint[-i] == 0 for i in range(1, input_dim-1)), \
             f'Input shape {input_.shape[2:]} not suited for downsampling with factors {self.scale_factors}.' \
             f'Lengths of spatial axes must be multiples of {self.divisibility_constraint}.'
+        if self.channels_last:
+            input_ = input_.contiguous(memory_format=torch.channels_last if self.dim == 2 else torch.channels_last_3d)
+        if self.amp_dtype is not None:
+            with torch.autocast(device_type=input_.device.type, dtype=self.amp_dtype):
+                return super(UNet, self).forward(input_)
         return super(UNet, self).forward(input_)
 
 
@@ -541,14 +696,15 @@ class RecurrentUNet(UNet2d):
             :param input_ (Tensor): Shaped (batch, channels, x, y)
             :param sequence (bool): If True, input_ will be expected as
             (batch, channels, t, x, y), where the t is the time axis. The output
-            will be of the same shape. A use case is, for example, processing a 
+            will be of shape (batch, out_channels, t, x, y). A use case is, for example, processing a 
             batch of videos each with length t (or set batch=1 for a single video).
         """
         if sequence:
-            output = torch.zeros(input_.shape)
+            outputs = []
             for time_index in range(input_.shape[2]):
                 frame = input_[:,:, time_index, :,:] # (batch, ch, x, y)
-                output[:,:, time_index, :,:] = super(RecurrentUNet, self).forward(frame) 
+                outputs.append(super(RecurrentUNet, self).forward(frame))
+            output = torch.stack(outputs, dim=2)
         else:
             output = super(RecurrentUNet, self).forward(input_)
             
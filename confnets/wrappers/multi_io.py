@@ -1,5 +1,9 @@
+import logging
 import torch
 import torch.nn as nn
+from functools import partial
+
+logger = logging.getLogger(__name__)
 
 
 def _get_submodule(module, path):
@@ -28,17 +32,19 @@ class IntermediateOutputWrapper(nn.Module):
         self.saved_outputs = None
         self.output_modules = [_get_submodule(self.module, path) for path in output_paths]
         self.output_paths = output_paths
-        for module in self.output_modules:
-            print(module)
-            module.register_forward_hook(self.save_output)
+        for index, module in enumerate(self.output_modules):
+            logger.debug('Saving output of %s', module)
+            module.register_forward_hook(partial(self.save_output, index))
 
-    def save_output(self, module, input, output):
-        self.saved_outputs[module] = output
+    def save_output(self, index, module, input, output):
+        self.saved_outputs[index] = output
 
     def forward(self, *input):
-        self.saved_outputs = dict()
+        self.saved_outputs = [None] * len(self.output_modules)
         self.module.forward(*input)
-        return tuple((self.saved_outputs[module] for module in self.output_modules))
+        missing = [path for path, output in zip(self.output_paths, self.saved_outputs) if output is None]
+        assert not missing, f'Modules at {missing} were not called during the forward pass.'
+        return tuple(self.saved_outputs)
 
 
 class ChannelSliceWrapper(torch.nn.Module):